@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (c) 2015 The mogoweb project. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be
@@ -1,19 +1,19 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Copyright (c) 2015 The mogoweb project. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-import optparse
+import argparse
+import collections
+import concurrent.futures
+import copy
+import functools
 import os
 import sys
 
 import constants
-import resource_util
-import shutil
-
-sys.path.append(os.path.join(os.path.dirname(__file__), "dirsync-2.1"))
-from dirsync import sync
+import sync_util
 
 java_srcs = [
     "base/android/java/src",
@@ -137,139 +137,241 @@ data_files = [
     "snapshot_blob.bin",
 ]
 
+# sync filters. They are built once here instead of for every synced tree.
+# Plain prefix and suffix tests are used where a regex would only anchor a
+# literal, and are much cheaper per path than the regex engine.
+grit_res_args = {'exclude': [sync_util.Prefix('values-')],
+                 'include': [sync_util.Prefix('values-zh-rCN')]}
+
+jar_args = {'only': [sync_util.Suffix('.jar')],
+            'ignore': [sync_util.Suffix('interface.jar'),
+                       sync_util.Prefix('android_support_', 'support-annotations')]}
+
+manifest_args = {'only': frozenset(['AndroidManifest.xml'])}
+
+# Number of threads used to sync the independent source trees of one task.
+SYNC_THREADS = 8
+# Maximum number of concurrent file copies, enough to keep the queue of an
+# SSD busy.
+COPY_THREADS = 16
+
+def run_threads(calls, max_workers=SYNC_THREADS):
+    # run the calls concurrently and re-raise the first failure. Syncing and
+    # copying spend most of their time in stat and copy syscalls, which
+    # release the GIL.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(call) for call in calls]
+        for future in futures:
+            future.result()
+
+def sync_trees(trees, **kwargs):
+    # sync [src, dst, args] entries concurrently
+    run_threads([functools.partial(sync_util.sync_tree, src, dst, **dict(args, **kwargs))
+                 for src, dst, args in trees])
+
+def sync_sources(sources, dst, **kwargs):
+    # sync [src, args] entries into dst one after the other. As with dirsync,
+    # a file shared by several sources is only overwritten by a later source
+    # when that one is newer, so the newest copy wins whatever the order.
+    for src, args in sources:
+        sync_util.sync_tree(src, dst, **dict(args, **kwargs))
+
+def copy_files(files, hardlink=False):
+    # copy [src, dst] entries concurrently, the kernel does the actual copy
+    # so the large files are not serialized behind each other
+    copy_one = sync_util.link_file if hardlink else sync_util.copy_file
+    run_threads([functools.partial(copy_one, src, dst) for src, dst in files],
+                max_workers=max(1, min(COPY_THREADS, len(files))))
+
 def sync_java_files(options):
     app_java_dir = os.path.join(constants.DIR_APP_ROOT, "src", "main", "java")
+    # the source trees hold disjoint packages, so they can be synced in any
+    # order, but they all share the org/chromium/... part of app_java_dir.
+    # The exclusive cache fails the sync should two trees ever share a file.
+    trees = []
     for java_dir in java_srcs:
         chrome_java_dir = os.path.join(options.chromium_root, java_dir)
-        sync(chrome_java_dir, app_java_dir, "sync")
+        trees.append([chrome_java_dir, app_java_dir, {}])
+    sync_trees(trees, cache=sync_util.StatCache(exclusive=True), manifest=options.manifest)
 
     # copy special java files
+    files = []
     for special_java_file in special_java_files:
-        src_file = os.path.join(options.chromium_root, "out", options.buildtype, special_java_file[0])
-        dst = os.path.join(constants.DIR_APP_ROOT, "src", "main", "java", special_java_file[1])
-        shutil.copy(src_file, dst)
+        src_file = os.path.join(options.out_dir, special_java_file[0])
+        dst = os.path.join(app_java_dir, special_java_file[1])
+        files.append([src_file, dst])
+    copy_files(files)
 
 def sync_res_files(options):
+    # several source trees feed some libraries, each library is synced by
+    # one thread in list order while the libraries are synced concurrently
+    libraries = collections.OrderedDict()
     for res_dir in res_dirs:
         chrome_res_dir = os.path.join(options.chromium_root, res_dir[0])
         app_res_dir = os.path.join(constants.DIR_LIBRARIES_ROOT, res_dir[1], "src", "main", "res")
-        sync(chrome_res_dir, app_res_dir, "sync")
+        libraries.setdefault(app_res_dir, []).append([chrome_res_dir, {}])
 
     for gen_res_dir in gen_res_dirs:
-        chrome_gen_res_dir = os.path.join(options.chromium_root, "out", options.buildtype, gen_res_dir[0])
+        chrome_gen_res_dir = os.path.join(options.out_dir, gen_res_dir[0])
         app_res_dir = os.path.join(constants.DIR_LIBRARIES_ROOT, gen_res_dir[1], "src", "main", "res")
-        args = {'exclude': ['values-\S+'], 'include': ['values-zh-rCN']}
-        sync(chrome_gen_res_dir, app_res_dir, "sync", **args)
+        libraries.setdefault(app_res_dir, []).append([chrome_gen_res_dir, grit_res_args])
+
+    # the sources of a library share its destination listings, so files
+    # already stat'ed by one pass are not stat'ed again by the next
+    run_threads([functools.partial(sync_sources, sources, app_res_dir,
+                                   cache=sync_util.StatCache(),
+                                   manifest=options.manifest)
+                 for app_res_dir, sources in libraries.items()])
 
 def sync_so_files(options):
     app_lib_dir = os.path.join(constants.DIR_APP_ROOT, "src", "main", "jniLibs", "armeabi-v7a")
+    files = []
     for so_file in so_files:
-        chrome_so = os.path.join(options.chromium_root, "out", options.buildtype, so_file)
-        shutil.copy(chrome_so, app_lib_dir)
+        chrome_so = os.path.join(options.out_dir, so_file)
+        files.append([chrome_so, app_lib_dir])
+    copy_files(files, hardlink=options.hardlink)
 
 def sync_jar_files(options):
     app_lib_dir = os.path.join(constants.DIR_APP_ROOT, "libs")
-    args = {'only':['.+\\.jar$'],
-            'ignore': ['.+interface\\.jar$', '^android_support_', '^support-annotations']}
+    trees = []
     for jar_dir in jar_dirs:
-        chrome_java_lib_dir = os.path.join(options.chromium_root, "out", options.buildtype, "lib.java", jar_dir)
-        sync(chrome_java_lib_dir, app_lib_dir, "sync", **args)
+        chrome_java_lib_dir = os.path.join(options.out_dir, "lib.java", jar_dir)
+        trees.append([chrome_java_lib_dir, app_lib_dir, jar_args])
+    sync_trees(trees, cache=sync_util.StatCache(), manifest=options.manifest)
 
 def sync_chromium_res_files(options):
     library_res_dir = os.path.join(constants.DIR_LIBRARIES_ROOT, "chrome_res", "src", "main", "res")
-    chrome_res_dir = os.path.join(options.chromium_root, "chrome", "android", "java", "res")
-    sync(chrome_res_dir, library_res_dir, "sync")
-
-    chrome_res_dir = os.path.join(options.chromium_root, "chrome", "android", "java", "res_chromium")
-    sync(chrome_res_dir, library_res_dir, "sync")
-
-    # sync chrome generated string resources
-    chrome_gen_res_dir = os.path.join(options.chromium_root, "out", options.buildtype,
-                                      "gen", "chrome", "java", "res")
-    sync(chrome_gen_res_dir, library_res_dir, "sync")
-
-    # sync grd generated string resources
-    chrome_grd_res_dir = os.path.join(options.chromium_root, "out", options.buildtype,
-                                      "obj", "chrome", "chrome_strings_grd.gen", "chrome_strings_grd", "res_grit")
-    args = {'exclude': ['values-\S+'], 'include': ['values-zh-rCN']}
-    sync(chrome_grd_res_dir, library_res_dir, "sync", **args)
+    sources = [
+        [os.path.join(options.chromium_root, "chrome", "android", "java", "res"), {}],
+        [os.path.join(options.chromium_root, "chrome", "android", "java", "res_chromium"), {}],
+        # chrome generated string resources
+        [os.path.join(options.out_dir, "gen", "chrome", "java", "res"), {}],
+        # grd generated string resources
+        [os.path.join(options.out_dir,
+                      "obj", "chrome", "chrome_strings_grd.gen", "chrome_strings_grd", "res_grit"),
+         grit_res_args],
+    ]
+    sync_sources(sources, library_res_dir, cache=sync_util.StatCache(),
+                 manifest=options.manifest)
 
-    # remove duplicate strings in android_chrome_strings.xml and generated_resources.xml
+    # remove duplicate strings in android_chrome_strings.xml and generated_resources.xml,
+    # resource_util pulls in ElementTree, so it is only imported when needed
+    import resource_util
     resource_util.remove_duplicated_strings(library_res_dir + '/values/android_chrome_strings.xml',
                                             library_res_dir + '/values/generated_resources.xml')
 
 def sync_ui_res_files(options):
     library_res_dir = os.path.join(constants.DIR_LIBRARIES_ROOT, "ui_res", "src", "main", "res")
-    ui_res_dir = os.path.join(options.chromium_root, "ui", "android", "java", "res")
-
-    sync(ui_res_dir, library_res_dir, "sync")
-
-    # sync grd generated string resources
-    ui_grd_res_dir = os.path.join(options.chromium_root, "out", options.buildtype,
-                                      "obj", "ui", "android", "ui_strings_grd.gen", "ui_strings_grd", "res_grit")
-    args = {'exclude': ['values-\S+'], 'include': ['values-zh-rCN']}
-    sync(ui_grd_res_dir, library_res_dir, "sync", **args)
+    sources = [
+        [os.path.join(options.chromium_root, "ui", "android", "java", "res"), {}],
+        # grd generated string resources
+        [os.path.join(options.out_dir,
+                      "obj", "ui", "android", "ui_strings_grd.gen", "ui_strings_grd", "res_grit"),
+         grit_res_args],
+    ]
+    sync_sources(sources, library_res_dir, cache=sync_util.StatCache(),
+                 manifest=options.manifest)
 
 def sync_content_res_files(options):
     library_res_dir = os.path.join(constants.DIR_LIBRARIES_ROOT, "content_res", "src", "main", "res")
-    content_res_dir = os.path.join(options.chromium_root, "content", "public", "android", "java", "res")
-    sync(content_res_dir, library_res_dir, "sync")
-
-    # sync grd generated string resources
-    content_grd_res_dir = os.path.join(options.chromium_root, "out", options.buildtype,
-                                  "obj", "content", "content_strings_grd.gen", "content_strings_grd", "res_grit")
-    args = {'exclude': ['values-\S+'], 'include': ['values-zh-rCN']}
-    sync(content_grd_res_dir, library_res_dir, "sync", **args)
+    sources = [
+        [os.path.join(options.chromium_root, "content", "public", "android", "java", "res"), {}],
+        # grd generated string resources
+        [os.path.join(options.out_dir,
+                      "obj", "content", "content_strings_grd.gen", "content_strings_grd", "res_grit"),
+         grit_res_args],
+    ]
+    sync_sources(sources, library_res_dir, cache=sync_util.StatCache(),
+                 manifest=options.manifest)
 
 def sync_datausagechart_res_files(options):
     library_res_dir = os.path.join(constants.DIR_LIBRARIES_ROOT, "datausagechart_res", "src", "main", "res")
     datausagechart_res_dir = os.path.join(options.chromium_root, "third_party", "android_data_chart", "java", "res")
-    sync(datausagechart_res_dir, library_res_dir, "sync")
+    sync_util.sync_tree(datausagechart_res_dir, library_res_dir, manifest=options.manifest)
 
 def sync_androidmedia_res_files(options):
     library_res_dir = os.path.join(constants.DIR_LIBRARIES_ROOT, "androidmedia_res", "src", "main", "res")
     media_res_dir = os.path.join(options.chromium_root, "third_party", "android_media", "java", "res")
-    sync(media_res_dir, library_res_dir, "sync")
+    sync_util.sync_tree(media_res_dir, library_res_dir, manifest=options.manifest)
 
 def sync_manifest_files(options):
     main_dir = os.path.join(constants.DIR_APP_ROOT, "src", "main")
-    public_apk_gen_dir = os.path.join(options.chromium_root, "out", options.buildtype,
-                                      "gen/chrome/android/chrome_public_apk")
-    args = {'only': ['AndroidManifest\\.xml']}
-    sync(public_apk_gen_dir, main_dir, "sync", **args)
+    public_apk_gen_dir = os.path.join(options.out_dir, "gen/chrome/android/chrome_public_apk")
+    sync_util.sync_tree(public_apk_gen_dir, main_dir, manifest=options.manifest, **manifest_args)
 
 def sync_data_files(options):
     assets_dir = os.path.join(constants.DIR_APP_ROOT, "src", "main", "assets")
-    pak_gen_dir = os.path.join(options.chromium_root, "out", options.buildtype, "locales")
-    sync(pak_gen_dir, assets_dir, "sync")
+    pak_gen_dir = os.path.join(options.out_dir, "locales")
+    sync_util.sync_tree(pak_gen_dir, assets_dir, manifest=options.manifest)
 
+    files = []
     for data_file in data_files:
-        chrome_data_file = os.path.join(options.chromium_root, "out", options.buildtype, data_file)
+        chrome_data_file = os.path.join(options.out_dir, data_file)
         if data_file == "snapshot_blob.bin":
-            assets_dir = os.path.join(assets_dir, "snapshot_blob_32.bin")
-        shutil.copy(chrome_data_file, assets_dir)
+            dst = os.path.join(assets_dir, "snapshot_blob_32.bin")
+        else:
+            dst = assets_dir
+        files.append([chrome_data_file, dst])
+    copy_files(files, hardlink=options.hardlink)
+
+# Top-level sync tasks. They write to disjoint destination trees, so they can
+# run concurrently in separate processes. sync_so_files comes first so its
+# large, bandwidth bound copies start right away and overlap with the small
+# file syncs instead of waiting for a free worker.
+sync_tasks = [
+    sync_so_files,
+    sync_java_files,
+    sync_res_files,
+    sync_jar_files,
+    # sync_chromium_res_files,
+    # sync_ui_res_files,
+    # sync_content_res_files,
+    # sync_datausagechart_res_files,
+    # sync_androidmedia_res_files,
+    sync_manifest_files,
+    sync_data_files,
+]
+
+def run_sync_task(task, options):
+    # every task keeps its own manifest so tasks running in different
+    # processes never write the same file
+    options = copy.copy(options)
+    options.manifest = sync_util.Manifest(
+        os.path.join(constants.DIR_APP_ROOT, ".sync_manifest", task.__name__ + ".json"))
+    task(options)
+    options.manifest.save()
+
+def run_sync_tasks(options):
+    if options.jobs <= 1:
+        for task in sync_tasks:
+            run_sync_task(task, options)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        futures = [executor.submit(run_sync_task, task, options) for task in sync_tasks]
+        concurrent.futures.wait(futures)
+        # re-raise the first failure, if any
+        for future in futures:
+            future.result()
 
 def main(argv):
-    parser = optparse.OptionParser(usage='Usage: %prog [options]', description=__doc__)
-    parser.add_option('--chromium_root',
-                      default="/work/chromium/master/chromium-android/src",
-                      help="The root of chromium sources")
-    parser.add_option('--buildtype',
-                      default="Default",
-                      help="build type of chromium build(Default, Debug or Release, etc), default Default")
-    options, args = parser.parse_args(argv)
-
-    sync_java_files(options)
-    sync_res_files(options)
-    sync_jar_files(options)
-    sync_so_files(options)
-    # sync_chromium_res_files(options)
-    # sync_ui_res_files(options)
-    # sync_content_res_files(options)
-    # sync_datausagechart_res_files(options)
-    # sync_androidmedia_res_files(options)
-    sync_manifest_files(options)
-    sync_data_files(options)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chromium_root',
+                        default="/work/chromium/master/chromium-android/src",
+                        help="The root of chromium sources")
+    parser.add_argument('--buildtype',
+                        default="Default",
+                        help="build type of chromium build(Default, Debug or Release, etc), default Default")
+    parser.add_argument('--jobs', type=int,
+                        default=min(len(sync_tasks), os.cpu_count() or 1),
+                        help="number of sync tasks to run in parallel, 1 runs them serially")
+    parser.add_argument('--hardlink', action='store_true',
+                        help="hard link the libraries and data files instead of copying them "
+                             "when possible, edits to either side then show up in both")
+    options = parser.parse_args(argv[1:])
+    options.out_dir = os.path.join(options.chromium_root, "out", options.buildtype)
+
+    run_sync_tasks(options)
 
 if __name__ == '__main__':
     main(sys.argv)
\ No newline at end of file
@@ -0,0 +1,357 @@
+# Copyright (c) 2015 The mogoweb project. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import errno
+import json
+import os
+import re
+import shutil
+import stat
+import sys
+import threading
+
+# copy_file_range(), sendfile() to a regular file and posix_fadvise() are
+# all available on Linux, elsewhere (e.g. macOS, where sendfile() only
+# writes to sockets) copies go through shutil
+_KERNEL_COPY = sys.platform.startswith("linux")
+
+_COPY_FILE_RANGE_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+def _report(msg):
+    # syncs run in several threads, and print() writes the message and its
+    # newline separately, so lines from different threads get interleaved
+    sys.stdout.write(msg + "\n")
+
+class Prefix(object):
+    """Filter pattern matching paths that start with one of the given
+    strings, a cheaper stand-in for a regex like r'^a|^b'."""
+
+    def __init__(self, *prefixes):
+        self.prefixes = prefixes
+
+    def match(self, path):
+        return path.startswith(self.prefixes)
+
+class Suffix(object):
+    """Filter pattern matching paths that end with one of the given
+    strings, a cheaper stand-in for a regex like r'.+a$|.+b$'."""
+
+    def __init__(self, *suffixes):
+        self.suffixes = suffixes
+
+    def match(self, path):
+        return path.endswith(self.suffixes)
+
+def _matcher(patterns):
+    # join the patterns of a filter into one alternation, so each path needs
+    # a single match call however many patterns the filter has, and hand
+    # out the bound match method to save the attribute lookup per path
+    if isinstance(patterns, (set, frozenset)):
+        # exact relative paths need a hash lookup, not a regex
+        return patterns.__contains__ if patterns else None
+    prefixes = ()
+    suffixes = ()
+    regexes = []
+    for pattern in patterns:
+        if isinstance(pattern, Prefix):
+            prefixes += pattern.prefixes
+        elif isinstance(pattern, Suffix):
+            suffixes += pattern.suffixes
+        else:
+            regexes.append(pattern)
+
+    matchers = []
+    if prefixes:
+        matchers.append(Prefix(*prefixes).match)
+    if suffixes:
+        matchers.append(Suffix(*suffixes).match)
+    if len(regexes) == 1:
+        matchers.append(re.compile(regexes[0]).match)
+    elif regexes:
+        matchers.append(re.compile("|".join("(?:%s)" % getattr(pattern, "pattern", pattern)
+                                            for pattern in regexes)).match)
+    if not matchers:
+        return None
+    if len(matchers) == 1:
+        return matchers[0]
+    return lambda path: any(match(path) for match in matchers)
+
+def _list_dir(path):
+    # map entry names to DirEntry objects, None if the directory is missing
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries}
+    except FileNotFoundError:
+        return None
+
+class StatCache(object):
+    """Destination directory listings shared by several sync_tree() calls,
+    so each target directory is listed only once."""
+
+    def __init__(self, exclusive=False):
+        # with exclusive set, the syncs sharing the cache run concurrently
+        # and must not provide the same destination file
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self._owners = {} if exclusive else None
+
+    def list_dir(self, path):
+        if path in self._dirs:
+            return self._dirs[path]
+        # list outside of the lock, but store under it so this cannot race
+        # with make_dir, and keep the listing of a thread that got there first
+        entries = _list_dir(path)
+        with self._lock:
+            return self._dirs.setdefault(path, entries)
+
+    def claim(self, path, src):
+        if self._owners is None:
+            return
+        with self._lock:
+            owner = self._owners.setdefault(path, src)
+        if owner != src:
+            raise ValueError("%s is synced from both %s and %s" % (path, owner, src))
+
+    def make_dir(self, path):
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            if self._dirs.get(path) is None:
+                self._dirs[path] = {}
+            return self._dirs[path]
+
+class Manifest(object):
+    """Source fingerprints (mtime_ns, size) recorded by the previous sync of
+    a task, used to skip destination files whose source did not change."""
+
+    def __init__(self, path):
+        self._path = path
+        try:
+            with open(path) as f:
+                self._previous = json.load(f)
+        except (IOError, ValueError):
+            self._previous = {}
+        self._current = {}
+
+    def unchanged(self, dst, st):
+        fingerprint = [st.st_mtime_ns, st.st_size]
+        if self._previous.get(dst) != fingerprint:
+            return False
+        self._current[dst] = fingerprint
+        return True
+
+    def record(self, dst, st):
+        self._current[dst] = [st.st_mtime_ns, st.st_size]
+
+    def save(self):
+        # write to a temporary file first so an interrupted run never
+        # leaves a truncated manifest behind
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._current, f)
+        os.replace(tmp_path, self._path)
+
+def _is_newer(st1, st2):
+    # same rule as dirsync: the source wins when it was modified, or had its
+    # inode changed, at least one millisecond after the target was modified
+    return (st1.st_mtime_ns - st2.st_mtime_ns >= 1000000 or
+            st1.st_ctime_ns - st2.st_mtime_ns >= 1000000)
+
+def _copy_fds(src_fd, dst_fd):
+    offset = 0
+    # copy_file_range() lets the filesystem share extents (reflinks on
+    # btrfs and XFS) or copy on the server side for NFS. It is refused
+    # across filesystems on older kernels, sendfile() still works there.
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                copied = os.copy_file_range(src_fd, dst_fd, 1 << 30, offset, offset)
+                if copied == 0:
+                    # some filesystems report 0 instead of failing, an
+                    # empty first chunk may not be the end of the file
+                    if offset == 0:
+                        break
+                    return
+                offset += copied
+        except OSError as e:
+            if offset or e.errno not in _COPY_FILE_RANGE_UNSUPPORTED:
+                raise
+
+    while True:
+        sent = os.sendfile(dst_fd, src_fd, offset, 1 << 20)
+        if sent == 0:
+            break
+        offset += sent
+
+def _copy_data(src, dst, stream=False):
+    # with stream set, src is read once from start to end and not needed
+    # again, so the kernel is told to read ahead aggressively and to drop
+    # its pages afterwards instead of evicting other cached files
+    if not _KERNEL_COPY:
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if stream:
+            os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            _copy_fds(fsrc.fileno(), fdst.fileno())
+        finally:
+            if stream:
+                os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def copy_file(src, dst):
+    """Copies src to dst, which may be a directory, with its mtime and exec
+    mode, unless dst already has the size and mtime of src. Returns dst."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    st = os.stat(src)
+    try:
+        dst_st = os.stat(dst)
+        if dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns:
+            return dst
+    except FileNotFoundError:
+        pass
+
+    _copy_data(src, dst, stream=True)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+    # as in sync_tree, the mode only matters when src is executable
+    if st.st_mode & 0o111:
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    return dst
+
+def link_file(src, dst):
+    """Hard links src as dst, which may be a directory, or copies it with
+    copy_file() across filesystems. Both then share content. Returns dst."""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    st = os.stat(src)
+    if st.st_dev != os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        return copy_file(src, dst)
+    try:
+        if os.path.samestat(st, os.stat(dst)):
+            return dst
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # linked by a concurrent sync in the meantime
+        pass
+    except OSError:
+        # some filesystems do not support hard links at all
+        return copy_file(src, dst)
+    return dst
+
+def sync_tree(src, dst, only=(), include=(), exclude=(), ignore=(), cache=None,
+              manifest=None):
+    """Copies the files of src missing or out of date in dst, like the "sync"
+    action of dirsync, and returns the list of copied files."""
+    if not os.path.isdir(src):
+        raise ValueError("Source directory %s does not exist!" % src)
+    if not os.path.isdir(dst):
+        raise ValueError("Target directory %s does not exist!" % dst)
+
+    if cache is None:
+        cache = StatCache()
+
+    # with exact paths to sync, only their parent directories can lead to
+    # a candidate, so no other directory is even listed
+    only_dirs = None
+    if isinstance(only, (set, frozenset)) and only:
+        only_dirs = set()
+        for path in only:
+            while "/" in path:
+                path = path.rsplit("/", 1)[0]
+                only_dirs.add(path)
+
+    only = _matcher(only)
+    include = _matcher(include)
+    excluded = _matcher(list(exclude) + list(ignore))
+
+    def wanted(path):
+        if only is not None and not only(path):
+            return False
+        # most paths are not excluded, so test that first and only consult
+        # the includes for the few that are
+        if excluded is None or not excluded(path):
+            return True
+        return include is not None and bool(include(path))
+
+    copied = []
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        # dst_dir ends with a separator, so entries are joined by concatenation
+        src_dir = os.path.join(src, rel_dir)
+        dst_dir = os.path.join(dst, rel_dir)
+        # like dirsync, report a directory that cannot be synced, e.g. as
+        # dst has a file in its place, and carry on with the other ones
+        try:
+            dst_entries = cache.list_dir(dst_dir)
+            with os.scandir(src_dir) as it:
+                src_entries = list(it)
+        except OSError as e:
+            _report("failed to sync %s: %s" % (src_dir, e))
+            continue
+
+        for entry in src_entries:
+            path = rel_dir + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if wanted(path) and (dst_entries is None or entry.name not in dst_entries):
+                    try:
+                        if dst_entries is None:
+                            dst_entries = cache.make_dir(dst_dir)
+                        cache.make_dir(dst_dir + entry.name + "/")
+                    except OSError as e:
+                        _report("failed to create %s: %s" % (dst_dir + entry.name, e))
+                        continue
+                    dst_entries[entry.name] = entry
+                if only_dirs is None or path in only_dirs:
+                    pending.append(path + "/")
+                continue
+
+            if not wanted(path):
+                continue
+
+            dst_file = dst_dir + entry.name
+            cache.claim(dst_file, src)
+            target = dst_entries.get(entry.name) if dst_entries else None
+            try:
+                if target is not None:
+                    if manifest is not None and manifest.unchanged(dst_file, entry.stat()):
+                        continue
+                    if not _is_newer(entry.stat(), target.stat()):
+                        if manifest is not None:
+                            manifest.record(dst_file, entry.stat())
+                        continue
+                    if entry.is_symlink():
+                        os.remove(dst_file)
+                elif dst_entries is None:
+                    dst_entries = cache.make_dir(dst_dir)
+
+                if entry.is_symlink():
+                    shutil.copy2(entry.path, dst_file, follow_symlinks=False)
+                else:
+                    # copy2 would stat the source again and copy its
+                    # permissions and extended attributes on top. Only
+                    # the modification time matters for later syncs, and
+                    # the mode only when the source is executable.
+                    st = entry.stat()
+                    _copy_data(entry.path, dst_file)
+                    os.utime(dst_file, ns=(st.st_atime_ns, st.st_mtime_ns))
+                    if st.st_mode & 0o111:
+                        os.chmod(dst_file, stat.S_IMODE(st.st_mode))
+                dst_entries[entry.name] = entry
+                copied.append(dst_file)
+                if manifest is not None:
+                    manifest.record(dst_file, entry.stat())
+            except OSError as e:
+                _report("failed to copy %s: %s" % (entry.path, e))
+
+    if copied:
+        _report("%d files copied from %s" % (len(copied), src))
+    return copied